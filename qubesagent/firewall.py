@@ -20,19 +20,34 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
+import concurrent.futures
+import difflib
+import hashlib
 import logging
 import os
+import re
 import socket
+import stat
 import subprocess
 import shutil
 import daemon
 
 import qubesdb
+
+try:
+    # python bindings of libnftables, shipped with nft >= 0.9
+    import nftables
+except ImportError:
+    nftables = None
 import sys
 
 import signal
 
 
+#: QubesDB entry name of a single rule
+RULENO_RE = re.compile(r'[0-9]{4}')
+
+
 class RuleParseError(Exception):
     pass
 
@@ -42,11 +57,38 @@ class RuleApplyError(Exception):
 
 
 class FirewallWorker(object):
+    #: QubesDB directory holding firewall rules, one subdirectory per
+    #: source address
+    rules_prefix = '/qubes-firewall/'
+    #: rule options allowing to merge rules differing only in dstports
+    mergeable_rule_opts = frozenset(['action', 'proto', 'dst4', 'dst6',
+                                     'dsthost', 'dstports'])
+    #: host mask, per address family
+    fullmask = {4: '/32', 6: '/128'}
+    #: protocol names differing between address families,
+    #: key: (family, protocol)
+    proto_map = {(6, 'icmp'): 'icmpv6'}
+    #: limit of ports in a single merged rule (a range counts as two ports),
+    #: None for no limit
+    max_merged_ports = 15
+
     def __init__(self):
         self.terminate_requested = False
         self.qdb = qubesdb.QubesDB()
         self.log = logging.getLogger('qubes.firewall')
         self.log.addHandler(logging.StreamHandler(sys.stderr))
+        #: DNS servers (per address family), valid until resolv.conf changes
+        self.dns_cache = {}
+        #: resolved addresses (or resolving error), key: (hostname, family)
+        self.gai_cache = {}
+        self.resolv_conf_mtime = None
+        #: parsed rules, key: target, then raw (bytes) rule value
+        self.rules_cache = {}
+        #: environment for notify-send, created on first use
+        self.notify_env = None
+        #: digest of the last script applied to a chain, per address family,
+        #: see :py:meth:`script_hash`
+        self.applied_hash = {4: {}, 6: {}}
 
     def init(self):
         """Create appropriate chains/tables"""
@@ -76,6 +118,50 @@ class FirewallWorker(object):
         """Apply rules in given source address"""
         raise NotImplementedError
 
+    @staticmethod
+    def script_hash(script):
+        """Digest of a generated rules script, to detect no-op updates"""
+        return hashlib.blake2b(script.encode(), digest_size=16).digest()
+
+    def apply_rules_batch(self, rules_per_source):
+        """Apply rules for multiple source addresses at once.
+
+        The default implementation applies them one by one, workers are
+        expected to override it with a single transaction.
+        Traffic of sources with invalid rules is blocked, without affecting
+        other sources.
+
+        :param rules_per_source: list of (source address, rules list) tuples
+        """
+        for source, rules in rules_per_source:
+            try:
+                self.apply_rules(source, rules)
+            except RuleParseError as e:
+                self.log_error(
+                    'Failed to parse rules for {} ({}), blocking traffic'.format(
+                        source, str(e)
+                    ))
+                self.apply_rules(source, [{'action': 'drop'}])
+
+    def prepare_source_rules(self, source, chain, rules, family):
+        """Translate rules of *source* for applying them in batch - if they
+        are invalid, return rules blocking its traffic instead, so other
+        sources in the batch are not affected.
+
+        :param source: source address
+        :param chain: name of the chain to put rules into
+        :param rules: rules list
+        :param family: address family, either 4 or 6
+        """
+        try:
+            return self.prepare_rules(chain, rules, family)
+        except RuleParseError as e:
+            self.log_error(
+                'Failed to parse rules for {} ({}), blocking traffic'.format(
+                    source, str(e)
+                ))
+            return self.prepare_rules(chain, [{'action': 'drop'}], family)
+
     def update_connected_ips(self, family):
         raise NotImplementedError
 
@@ -90,45 +176,128 @@ class FirewallWorker(object):
         script_dir_paths = ['/etc/qubes/qubes-firewall.d',
                             '/rw/config/qubes-firewall.d']
         for script_dir_path in script_dir_paths:
-            if not os.path.isdir(script_dir_path):
+            try:
+                d_scripts = sorted(os.scandir(script_dir_path),
+                                   key=lambda entry: entry.name)
+            except OSError:
+                # missing directory
                 continue
-            for d_script in sorted(os.listdir(script_dir_path)):
-                d_script_path = os.path.join(script_dir_path, d_script)
-                if os.path.isfile(d_script_path) and \
-                        os.access(d_script_path, os.X_OK):
-                    subprocess.call([d_script_path])
+            for d_script in d_scripts:
+                # DirEntry caches stat() result, don't call it twice
+                if d_script.is_file() and d_script.stat().st_mode & 0o111:
+                    subprocess.call([d_script.path])
 
     def run_user_script(self):
         """Run user script in /rw/config"""
         user_script_path = '/rw/config/qubes-firewall-user-script'
-        if os.path.isfile(user_script_path) and \
-                os.access(user_script_path, os.X_OK):
+        try:
+            user_script_mode = os.stat(user_script_path).st_mode
+        except OSError:
+            return
+        if stat.S_ISREG(user_script_mode) and user_script_mode & 0o111:
             subprocess.call([user_script_path])
 
     def read_rules(self, target):
         """Read rules from QubesDB and return them as a list of dicts"""
-        entries = self.qdb.multiread('/qubes-firewall/{}/'.format(target))
-        assert isinstance(entries, dict)
+        prefix = '{}{}/'.format(self.rules_prefix, target)
+        entries = self.qdb.multiread(prefix)
         # drop full path
-        entries = dict(((k.split('/')[3], v.decode())
-                        for k, v in entries.items()))
+        prefix_len = len(prefix)
+        entries = {k[prefix_len:]: v for k, v in entries.items()}
         if 'policy' not in entries:
+            self.rules_cache.pop(target, None)
             raise RuleParseError('No \'policy\' defined')
-        policy = entries.pop('policy')
+        policy = entries.pop('policy').decode()
+        # rules are usually rewritten all at once, even if only one of them
+        # changed - parse (and decode) only those not seen before
+        cached_rules = self.rules_cache.get(target, {})
+        parsed_rules = {}
         rules = []
         for ruleno, rule in sorted(entries.items()):
-            if len(ruleno) != 4 or not ruleno.isdigit():
+            if not RULENO_RE.fullmatch(ruleno):
                 raise RuleParseError(
-                    'Unexpected non-rule found: {}={}'.format(ruleno, rule))
-            rule_dict = dict(elem.split('=') for elem in rule.split(' '))
-            if 'action' not in rule_dict:
-                raise RuleParseError('Rule \'{}\' lack action'.format(rule))
+                    'Unexpected non-rule found: {}={}'.format(
+                        ruleno, rule.decode()))
+            rule_dict = cached_rules.get(rule)
+            if rule_dict is None:
+                rule_dict = self.parse_rule(rule.decode())
+            parsed_rules[rule] = rule_dict
             rules.append(rule_dict)
+        self.rules_cache[target] = parsed_rules
         rules.append({'action': policy})
         return rules
 
+    @staticmethod
+    def parse_rule(rule):
+        """Parse rule string ("key1=value1 key2=value2 ...") into a dict"""
+        rule_dict = {}
+        for elem in rule.split(' '):
+            key, sep, value = elem.partition('=')
+            if not sep:
+                raise RuleParseError(
+                    'Malformed rule option \'{}\' in rule \'{}\''.format(
+                        elem, rule))
+            rule_dict[key] = value
+        if 'action' not in rule_dict:
+            raise RuleParseError('Rule \'{}\' lack action'.format(rule))
+        return rule_dict
+
+    def merge_rules(self, rules):
+        """
+        Merge consecutive rules differing only in destination ports into
+        a single rule, to reduce the number of rules loaded into the kernel.
+        Only rules with explicit 'tcp' or 'udp' protocol are merged. Rules
+        are never reordered, so the result is equivalent to the original list.
+
+        :param rules: list of rules
+        :return: list of rules; 'dstports' of a merged rule is a comma
+        separated list of port ranges
+        """
+        # list of (rule, merge key, port ranges, ports count, port intervals)
+        groups = []
+        for rule in rules:
+            key = None
+            start, _, end = rule.get('dstports', '').partition('-')
+            count = 1 if end in ('', start) else 2
+            if 'dstports' in rule and rule.get('proto') in ('tcp', 'udp') \
+                    and rule.keys() <= self.mergeable_rule_opts:
+                try:
+                    interval = (int(start), int(end or start))
+                    key = frozenset(item for item in rule.items()
+                                    if item[0] != 'dstports')
+                except ValueError:
+                    # invalid ports - leave reporting it to prepare_rules
+                    pass
+            # overlapping port ranges (including duplicated rules) in a
+            # single nft set are rejected by some nft versions
+            if key is not None and groups and groups[-1][1] == key and \
+                    (self.max_merged_ports is None or
+                     groups[-1][3] + count <= self.max_merged_ports) and \
+                    not any(interval[0] <= other[1] and other[0] <= interval[1]
+                            for other in groups[-1][4]):
+                groups[-1][2].append(rule['dstports'])
+                groups[-1][3] += count
+                groups[-1][4].append(interval)
+            else:
+                groups.append([rule, key, [rule.get('dstports')], count,
+                               [interval] if key is not None else []])
+
+        merged = []
+        for rule, _, port_ranges, _, _ in groups:
+            if len(port_ranges) > 1:
+                # don't modify the original rule, it may be cached
+                rule = dict(rule, dstports=','.join(port_ranges))
+            merged.append(rule)
+        return merged
+
     def list_targets(self):
-        return set(t.split('/')[2] for t in self.qdb.list('/qubes-firewall/'))
+        prefix_len = len(self.rules_prefix)
+        targets = {t[prefix_len:].split('/', 1)[0]
+                   for t in self.qdb.list(self.rules_prefix)}
+        # forget parsed rules of addresses that are gone
+        for target in set(self.rules_cache).difference(targets):
+            del self.rules_cache[target]
+        return targets
 
     @staticmethod
     def is_ip6(addr):
@@ -136,9 +305,14 @@ class FirewallWorker(object):
 
     def log_error(self, msg):
         self.log.error(msg)
+        if self.notify_env is None:
+            self.notify_env = dict(os.environ, DISPLAY=':0')
         subprocess.call(
             ['notify-send', '-t', '3000', msg],
-            env=os.environ.copy().update({'DISPLAY': ':0'})
+            env=self.notify_env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
         )
 
     def handle_addr(self, addr):
@@ -163,16 +337,144 @@ class FirewallWorker(object):
                 self.log_error(
                     'Failed to block traffic for {}'.format(addr))
 
+    def handle_addrs(self, addrs):
+        """Load rules for multiple source addresses in one batch.
+
+        If applying the whole batch fails, fall back to handling each address
+        separately, so a single broken ruleset does not affect other addresses.
+        """
+        rules_per_source = []
+        for addr in addrs:
+            try:
+                rules = self.read_rules(addr)
+            except RuleParseError as e:
+                self.log_error(
+                    'Failed to parse rules for {} ({}), blocking traffic'.format(
+                        addr, str(e)
+                    ))
+                rules = [{'action': 'drop'}]
+            rules_per_source.append((addr, rules))
+        self.resolve_batch(rules_per_source)
+        try:
+            self.apply_rules_batch(rules_per_source)
+        except (RuleParseError, RuleApplyError) as e:
+            self.log.warning(
+                'Failed to apply rules in batch ({}), '
+                'retrying each address separately'.format(str(e)))
+            for addr in addrs:
+                self.handle_addr(addr)
+
     @staticmethod
     def dns_addresses(family=None):
         with open('/etc/resolv.conf') as resolv:
-            for line in resolv.readlines():
-                line = line.strip()
-                if line.startswith('nameserver'):
-                    if line.count('.') == 3 and (family or 4) == 4:
-                        yield line.split(' ')[1]
-                    elif line.count(':') and (family or 6) == 6:
-                        yield line.split(' ')[1]
+            for line in resolv.read().splitlines():
+                if not line.startswith('nameserver'):
+                    continue
+                fields = line.split(None, 2)
+                if len(fields) < 2:
+                    continue
+                addr = fields[1]
+                if ':' in addr:
+                    if (family or 6) == 6:
+                        yield addr
+                elif (family or 4) == 4:
+                    yield addr
+
+    def get_dns_addresses(self, family):
+        """Return DNS servers of given address family, read from
+        /etc/resolv.conf only once until it changes"""
+        if family not in self.dns_cache:
+            self.dns_cache[family] = list(self.dns_addresses(family))
+        return self.dns_cache[family]
+
+    def resolve(self, host, family):
+        """Resolve *host* into a set of addresses of given family.
+
+        Results are cached, so a host used in rules for multiple source
+        addresses is resolved only once.
+        """
+        if (host, family) not in self.gai_cache:
+            try:
+                addrinfo = socket.getaddrinfo(host, None,
+                    (socket.AF_INET6 if family == 6 else socket.AF_INET))
+            except socket.gaierror as e:
+                # cache failures too, to not wait for the resolver again
+                self.gai_cache[(host, family)] = RuleParseError(
+                    'Failed to resolve {}: {}'.format(host, str(e)))
+            else:
+                self.gai_cache[(host, family)] = \
+                    set(item[4][0] for item in addrinfo)
+        addresses = self.gai_cache[(host, family)]
+        if isinstance(addresses, RuleParseError):
+            raise addresses
+        if not addresses:
+            raise RuleParseError(
+                'Failed to resolve {}: no IPv{} address'.format(host, family))
+        return addresses
+
+    def resolve_unspec(self, host):
+        """Resolve *host* into addresses of both families at once, so
+        rules of both IPv4 and IPv6 source addresses need just one
+        getaddrinfo() call. Used only when loading multiple addresses at
+        once - otherwise the cache is cleared before the rules for the
+        other family are handled, and :py:meth:`resolve` asks only for the
+        family actually needed.
+
+        Results are stored in the cache used by :py:meth:`resolve`.
+        """
+        try:
+            addrinfo = socket.getaddrinfo(host, None)
+        except socket.gaierror as e:
+            error = RuleParseError(
+                'Failed to resolve {}: {}'.format(host, str(e)))
+            self.gai_cache[(host, 4)] = self.gai_cache[(host, 6)] = error
+            return
+        addresses = {4: set(), 6: set()}
+        for item in addrinfo:
+            if item[0] == socket.AF_INET:
+                addresses[4].add(item[4][0])
+            elif item[0] == socket.AF_INET6:
+                addresses[6].add(item[4][0])
+        for family in (4, 6):
+            self.gai_cache[(host, family)] = addresses[family]
+
+    def resolve_batch(self, rules_per_source):
+        """Resolve all hostnames used in rules, in parallel.
+
+        Results are stored in the cache used by :py:meth:`resolve`, so rules
+        translation later on doesn't wait for each DNS reply in turn.
+
+        :param rules_per_source: list of (source address, rules list) tuples
+        """
+        hosts = set(rule['dsthost']
+                    for _, rules in rules_per_source
+                    for rule in rules
+                    if 'dsthost' in rule)
+        hosts = set(host for host in hosts
+                    if (host, 4) not in self.gai_cache or
+                    (host, 6) not in self.gai_cache)
+        if not hosts:
+            return
+
+        # errors are reported when applying rules of given address
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(hosts), 8)) as executor:
+            list(executor.map(self.resolve_unspec, hosts))
+
+    def clear_caches(self):
+        """Forget cached DNS servers and resolved hostnames"""
+        self.dns_cache.clear()
+        self.gai_cache.clear()
+
+    def check_resolv_conf(self):
+        """Drop cached DNS servers list if /etc/resolv.conf has changed"""
+        try:
+            mtime = os.stat('/etc/resolv.conf').st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self.resolv_conf_mtime:
+            self.resolv_conf_mtime = mtime
+            self.dns_cache.clear()
 
     def main(self):
         self.terminate_requested = False
@@ -180,16 +482,22 @@ class FirewallWorker(object):
         self.run_firewall_dir()
         self.run_user_script()
         self.sd_notify('READY=1')
+        self.clear_caches()
+        self.check_resolv_conf()
         # initial load
-        for source_addr in self.list_targets():
-            self.handle_addr(source_addr)
+        self.handle_addrs(self.list_targets())
         self.update_connected_ips(4)
         self.update_connected_ips(6)
-        self.qdb.watch('/qubes-firewall/')
+        self.qdb.watch(self.rules_prefix)
         self.qdb.watch('/connected-ips')
         self.qdb.watch('/connected-ips6')
         try:
             for watch_path in iter(self.qdb.read_watch, None):
+                # hostnames are resolved again on each update, DNS servers
+                # are re-read only if resolv.conf was modified
+                self.gai_cache.clear()
+                self.check_resolv_conf()
+
                 if watch_path == '/connected-ips':
                     self.update_connected_ips(4)
 
@@ -198,8 +506,9 @@ class FirewallWorker(object):
 
                 # ignore writing rules itself - wait for final write at
                 # source_addr level empty write (/qubes-firewall/SOURCE_ADDR)
-                if watch_path.startswith('/qubes-firewall/') and watch_path.count('/') == 2:
-                    source_addr = watch_path.split('/')[2]
+                if watch_path.startswith(self.rules_prefix) and \
+                        watch_path.count('/') == 2:
+                    source_addr = watch_path[len(self.rules_prefix):]
                     self.handle_addr(source_addr)
 
         except OSError:  # EINTR
@@ -213,8 +522,15 @@ class FirewallWorker(object):
 
 
 class IptablesWorker(FirewallWorker):
-    supported_rule_opts = ['action', 'proto', 'dst4', 'dst6', 'dsthost',
-                           'dstports', 'specialtarget', 'icmptype']
+    supported_rule_opts = frozenset(['action', 'proto', 'dst4', 'dst6',
+                                     'dsthost', 'dstports', 'specialtarget',
+                                     'icmptype'])
+
+    #: iptables target for 'drop' action, per address family
+    reject_action = {
+        4: 'REJECT --reject-with icmp-admin-prohibited',
+        6: 'REJECT --reject-with icmp6-adm-prohibited',
+    }
 
     def __init__(self):
         super(IptablesWorker, self).__init__()
@@ -222,6 +538,11 @@ class IptablesWorker(FirewallWorker):
             4: set(),
             6: set(),
         }
+        #: rules currently loaded into each chain, see :py:meth:`chain_rules`
+        self.applied_rules = {
+            4: {},
+            6: {},
+        }
 
     @staticmethod
     def chain_for_addr(addr):
@@ -248,21 +569,40 @@ class IptablesWorker(FirewallWorker):
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.STDOUT)
 
-    def create_chain(self, addr, chain, family):
+    def prepare_chain(self, addr, chain, family):
         """
-        Create iptables chain and hook traffic coming from `addr` to it.
+        Helper function to prepare iptables-restore lines creating the chain
+        and hooking traffic coming from `addr` to it, or flushing the chain if
+        it already exists.
 
         :param addr: source IP from which traffic should be handled by the
         chain
-        :param chain: name of the chain to create
+        :param chain: name of the chain
         :param family: address family (4 or 6)
+        :return: input for iptables-restore, without '*filter' and 'COMMIT'
+        :rtype: str
+        """
+
+        if chain in self.chains[family]:
+            return '-F {}\n'.format(chain)
+        return '-N {chain}\n-I QBS-FORWARD -s {addr} -j {chain}\n'.format(
+            chain=chain, addr=addr)
+
+    def load_iptables(self, family, iptables):
+        """
+        Load rules with a single iptables-restore call, without flushing
+        the table.
+
+        :param family: address family (4 or 6)
+        :param iptables: input for iptables-restore
         :return: None
         """
 
-        self.run_ipt(family, ['-N', chain])
-        self.run_ipt(family,
-            ['-I', 'QBS-FORWARD', '-s', addr, '-j', chain])
-        self.chains[family].add(chain)
+        p = self.run_ipt_restore(family, ['-n'])
+        (output, _) = p.communicate(iptables.encode())
+        if p.returncode != 0:
+            raise RuleApplyError(
+                'iptables-restore failed: {}'.format(output))
 
     def prepare_rules(self, chain, rules, family):
         """
@@ -275,15 +615,15 @@ class IptablesWorker(FirewallWorker):
         :rtype: str
         """
 
-        iptables = "*filter\n"
+        iptables = ["*filter\n"]
 
-        fullmask = '/128' if family == 6 else '/32'
+        fullmask = self.fullmask[family]
 
-        dns = list(addr + fullmask for addr in self.dns_addresses(family))
+        dns = list(addr + fullmask for addr in
+                   self.get_dns_addresses(family))
 
-        for rule in rules:
-            unsupported_opts = set(rule.keys()).difference(
-                set(self.supported_rule_opts))
+        for rule in self.merge_rules(rules):
+            unsupported_opts = rule.keys() - self.supported_rule_opts
             if unsupported_opts:
                 raise RuleParseError(
                     'Unsupported rule option(s): {!s}'.format(unsupported_opts))
@@ -293,10 +633,8 @@ class IptablesWorker(FirewallWorker):
                 raise RuleParseError('dst6 rule found for IPv4 address')
 
             if 'proto' in rule:
-                if rule['proto'] == 'icmp' and family == 6:
-                    protos = ['icmpv6']
-                else:
-                    protos = [rule['proto']]
+                protos = [self.proto_map.get((family, rule['proto']),
+                                             rule['proto'])]
             else:
                 protos = None
 
@@ -305,13 +643,8 @@ class IptablesWorker(FirewallWorker):
             elif 'dst6' in rule:
                 dsthosts = [rule['dst6']]
             elif 'dsthost' in rule:
-                try:
-                    addrinfo = socket.getaddrinfo(rule['dsthost'], None,
-                        (socket.AF_INET6 if family == 6 else socket.AF_INET))
-                except socket.gaierror as e:
-                    raise RuleParseError('Failed to resolve {}: {}'.format(
-                        rule['dsthost'], str(e)))
-                dsthosts = set(item[4][0] + fullmask for item in addrinfo)
+                dsthosts = set(addr + fullmask for addr in
+                               self.resolve(rule['dsthost'], family))
             else:
                 dsthosts = None
 
@@ -351,30 +684,89 @@ class IptablesWorker(FirewallWorker):
             if rule['action'] == 'accept':
                 action = 'ACCEPT'
             elif rule['action'] == 'drop':
-                action = 'REJECT --reject-with {}'.format(
-                    'icmp6-adm-prohibited' if family == 6 else
-                    'icmp-admin-prohibited')
+                action = self.reject_action[family]
             else:
                 raise RuleParseError(
                     'Invalid rule action {}'.format(rule['action']))
 
-            # sorting here is only to ease writing tests
+            # parts common for all the protos/dsthosts combinations
+            if dstports is None:
+                ports_match = ''
+            elif ',' in dstports:
+                # multiport refuses single port written as a range
+                ports_match = ' -m multiport --dports {}'.format(','.join(
+                    port_range.split(':')[0]
+                    if len(set(port_range.split(':'))) == 1 else port_range
+                    for port_range in dstports.split(',')))
+            else:
+                ports_match = ' --dport {}'.format(dstports)
+            icmp_match = '' if icmptype is None else \
+                ' --icmp-type {}'.format(icmptype)
+            target = ' -j {}\n'.format(action)
+
+            # keep the order stable - otherwise the same rules could produce
+            # a different chain content and defeat prepare_rules_delta()
             for proto in sorted(protos):
+                proto_match = '' if proto is None else ' -p {}'.format(proto)
                 for dsthost in sorted(dsthosts):
-                    ipt_rule = '-A {}'.format(chain)
-                    if dsthost is not None:
-                        ipt_rule += ' -d {}'.format(dsthost)
-                    if proto is not None:
-                        ipt_rule += ' -p {}'.format(proto)
-                    if dstports is not None:
-                        ipt_rule += ' --dport {}'.format(dstports)
-                    if icmptype is not None:
-                        ipt_rule += ' --icmp-type {}'.format(icmptype)
-                    ipt_rule += ' -j {}\n'.format(action)
-                    iptables += ipt_rule
-
-        iptables += 'COMMIT\n'
-        return iptables
+                    dst_match = '' if dsthost is None else \
+                        ' -d {}'.format(dsthost)
+                    iptables.append('-A {}{}{}{}{}{}'.format(
+                        chain, dst_match, proto_match, ports_match,
+                        icmp_match, target))
+
+        iptables.append('COMMIT\n')
+        return ''.join(iptables)
+
+    @staticmethod
+    def chain_rules(chain, iptables):
+        """
+        Extract rules specifications from iptables-restore input generated by
+        :py:meth:`prepare_rules`
+
+        :param chain: name of the chain rules are put into
+        :param iptables: input for iptables-restore
+        :return: list of rules, without '-A chain' prefix
+        """
+        prefix = '-A {} '.format(chain)
+        return [line[len(prefix):] for line in iptables.splitlines()
+                if line.startswith(prefix)]
+
+    @staticmethod
+    def prepare_rules_delta(chain, old_rules, new_rules):
+        """
+        Helper function to prepare input for iptables-restore, changing
+        chain content from `old_rules` to `new_rules` without touching rules
+        present in both.
+
+        :param chain: name of the chain
+        :param old_rules: rules currently in the chain, as returned by
+        :py:meth:`chain_rules`
+        :param new_rules: rules to be loaded, as returned by
+        :py:meth:`chain_rules`
+        :return: input for iptables-restore, or None if most of the rules
+        changed and the chain should be reloaded as a whole
+        :rtype: str
+        """
+
+        matcher = difflib.SequenceMatcher(None, old_rules, new_rules,
+                                          autojunk=False)
+        changes = [op for op in matcher.get_opcodes() if op[0] != 'equal']
+        changed_count = sum(max(i2 - i1, j2 - j1)
+                            for _, i1, i2, j1, j2 in changes)
+        if changed_count * 2 > max(len(old_rules), len(new_rules)):
+            return None
+
+        iptables = ['*filter\n']
+        # go from the end of the chain, so rule numbers of not yet processed
+        # changes stay valid
+        for _, i1, i2, j1, j2 in reversed(changes):
+            for ruleno in range(i2, i1, -1):
+                iptables.append('-D {} {}\n'.format(chain, ruleno))
+            for ruleno, rule in enumerate(new_rules[j1:j2], i1 + 1):
+                iptables.append('-I {} {} {}\n'.format(chain, ruleno, rule))
+        iptables.append('COMMIT\n')
+        return ''.join(iptables)
 
     def apply_rules_family(self, source, rules, family):
         """
@@ -388,20 +780,30 @@ class IptablesWorker(FirewallWorker):
         """
 
         chain = self.chain_for_addr(source)
-        if chain not in self.chains[family]:
-            self.create_chain(source, chain, family)
-
         iptables = self.prepare_rules(chain, rules, family)
-        try:
-            self.run_ipt(family, ['-F', chain])
-            p = self.run_ipt_restore(family, ['-n'])
-            (output, _) = p.communicate(iptables.encode())
-            if p.returncode != 0:
-                raise RuleApplyError(
-                    'iptables-restore failed: {}'.format(output))
-        except subprocess.CalledProcessError as e:
-            raise RuleApplyError('\'iptables -F {}\' failed: {}'.format(
-                chain, e.output))
+        new_hash = self.script_hash(iptables)
+        if chain in self.chains[family] and \
+                self.applied_hash[family].get(chain) == new_hash:
+            # rules not changed, nothing to do
+            return
+        new_rules = self.chain_rules(chain, iptables)
+        # forget applied rules until the update succeeds
+        old_rules = self.applied_rules[family].pop(chain, None)
+        self.applied_hash[family].pop(chain, None)
+        delta = None
+        if old_rules is not None and chain in self.chains[family]:
+            delta = self.prepare_rules_delta(chain, old_rules, new_rules)
+        if delta is None:
+            # create or flush the chain in the same transaction
+            iptables = '*filter\n' + \
+                self.prepare_chain(source, chain, family) + \
+                iptables[len('*filter\n'):]
+        else:
+            iptables = delta
+        self.load_iptables(family, iptables)
+        self.chains[family].add(chain)
+        self.applied_rules[family][chain] = new_rules
+        self.applied_hash[family][chain] = new_hash
 
     def apply_rules(self, source, rules):
         if self.is_ip6(source):
@@ -409,6 +811,43 @@ class IptablesWorker(FirewallWorker):
         else:
             self.apply_rules_family(source, rules, 4)
 
+    def apply_rules_batch(self, rules_per_source):
+        """
+        Apply rules for multiple source addresses, using a single
+        iptables-restore call for each address family.
+
+        :param rules_per_source: list of (source address, rules list) tuples
+        :return: None
+        """
+
+        iptables = {4: [], 6: []}
+        new_rules = {4: {}, 6: {}}
+        new_hash = {4: {}, 6: {}}
+        for source, rules in rules_per_source:
+            family = 6 if self.is_ip6(source) else 4
+            chain = self.chain_for_addr(source)
+            iptables[family].append(self.prepare_chain(source, chain, family))
+            # strip "*filter" and "COMMIT" - the whole batch is committed at
+            # once
+            chain_iptables = self.prepare_source_rules(
+                source, chain, rules, family)
+            new_rules[family][chain] = self.chain_rules(chain, chain_iptables)
+            new_hash[family][chain] = self.script_hash(chain_iptables)
+            iptables[family].append(
+                chain_iptables[len('*filter\n'):-len('COMMIT\n')])
+
+        for family in (4, 6):
+            if not iptables[family]:
+                continue
+            for chain in new_rules[family]:
+                self.applied_rules[family].pop(chain, None)
+                self.applied_hash[family].pop(chain, None)
+            self.load_iptables(family,
+                '*filter\n' + ''.join(iptables[family]) + 'COMMIT\n')
+            self.chains[family].update(new_rules[family])
+            self.applied_rules[family].update(new_rules[family])
+            self.applied_hash[family].update(new_hash[family])
+
     def update_connected_ips(self, family):
         ips = self.get_connected_ips(family)
 
@@ -439,6 +878,8 @@ class IptablesWorker(FirewallWorker):
     def init(self):
         # Chains QBS-FORWARD, QBS-PREROUTING, QBS-POSTROUTING
         # need to be created before running this.
+        for family in (4, 6):
+            self.applied_hash[family].clear()
         try:
             self.run_ipt(4, ['-F', 'QBS-FORWARD'])
             self.run_ipt(4,
@@ -469,11 +910,30 @@ class IptablesWorker(FirewallWorker):
             for chain in self.chains[family]:
                 self.run_ipt(family, ['-F', chain])
                 self.run_ipt(family, ['-X', chain])
+            self.applied_rules[family].clear()
+            self.applied_hash[family].clear()
 
 
 class NftablesWorker(FirewallWorker):
-    supported_rule_opts = ['action', 'proto', 'dst4', 'dst6', 'dsthost',
-                           'dstports', 'specialtarget', 'icmptype']
+    supported_rule_opts = frozenset(['action', 'proto', 'dst4', 'dst6',
+                                     'dsthost', 'dstports', 'specialtarget',
+                                     'icmptype'])
+
+    #: nft sets have no size limit
+    max_merged_ports = None
+    #: nft family name (also used for address matches), per address family
+    nft_family = {4: 'ip', 6: 'ip6'}
+    #: nft protocol match, per address family
+    proto_match = {4: 'ip protocol', 6: 'ip6 nexthdr'}
+    #: nft type of address set elements, per address family
+    addr_type = {4: 'ipv4_addr', 6: 'ipv6_addr'}
+    #: reference to a named set of dsthost addresses in nft input
+    host_set_re = re.compile(r'@(host-[0-9a-f]+)')
+    #: nft verdict for 'drop' action, per address family
+    reject_action = {
+        4: 'reject with icmp type admin-prohibited',
+        6: 'reject with icmpv6 type admin-prohibited',
+    }
 
     def __init__(self):
         super(NftablesWorker, self).__init__()
@@ -481,6 +941,16 @@ class NftablesWorker(FirewallWorker):
             4: set(),
             6: set(),
         }
+        #: addresses of named dsthost sets, key: set name, per address family
+        self.host_sets = {4: {}, 6: {}}
+        #: dsthost sets referenced by loaded chains, key: chain name, per
+        #: address family
+        self.set_refs = {4: {}, 6: {}}
+        #: content of loaded 'dns' set, per address family
+        self.dns_set = {4: None, 6: None}
+        #: libnftables handle, if available - avoids spawning nft process
+        #: for each update; None if not created yet, False if not available
+        self.nft = None
 
     @staticmethod
     def chain_for_addr(addr):
@@ -488,7 +958,21 @@ class NftablesWorker(FirewallWorker):
         return 'qbs-' + addr.replace('.', '-').replace(':', '-')
 
     def run_nft(self, nft_input):
-        # pylint: disable=no-self-use
+        if self.nft is None:
+            # create the handle on first use only - it holds a netlink
+            # socket, which would be closed when entering the daemon context
+            self.nft = False
+            if nftables is not None:
+                try:
+                    self.nft = nftables.Nftables()
+                except OSError:
+                    # libnftables.so missing, fallback to nft binary
+                    pass
+        if self.nft:
+            rc, output, error = self.nft.cmd(nft_input)
+            if rc != 0:
+                raise RuleApplyError('nft failed: {}'.format(error or output))
+            return
         p = subprocess.Popen(['nft', '-f', '/dev/stdin'],
                              stdin=subprocess.PIPE,
                              stdout=subprocess.PIPE,
@@ -497,35 +981,99 @@ class NftablesWorker(FirewallWorker):
         if p.returncode != 0:
             raise RuleApplyError('nft failed: {}'.format(stdout))
 
-    def create_chain(self, addr, chain, family):
+    def prepare_chain(self, addr, chain, family):
         """
-        Create iptables chain and hook traffic coming from `addr` to it.
+        Helper function to prepare nft input creating chain for `addr`
 
         :param addr: source IP from which traffic should be handled by the
         chain
         :param chain: name of the chain to create
         :param family: address family (4 or 6)
-        :return: None
+        :return: input for nft
+        :rtype: str
         """
-        nft_input = (
+        return (
             'table {family} {table} {{\n'
             '  chain {chain} {{\n'
             '  }}\n'
-            '  chain forward {{\n'
-            '    {family} saddr {ip} jump {chain}\n'
-            '  }}\n'
-            '}}\n'.format(
-                family=("ip6" if family == 6 else "ip"),
+            '}}\n'
+            'add element {family} {table} addr2chain '
+            '{{ {ip} : jump {chain} }}\n'.format(
+                family=self.nft_family[family],
                 table='qubes-firewall',
                 chain=chain,
                 ip=addr,
             )
         )
-        self.run_nft(nft_input)
-        self.chains[family].add(chain)
+
+    def host_set(self, addresses, family):
+        """
+        Get name of a named set holding given addresses. The name depends
+        only on the set content, so chains allowing the same hosts share it.
+
+        :param addresses: resolved addresses
+        :param family: address family (4 or 6)
+        :return: set name
+        :rtype: str
+        """
+        addresses = sorted(addresses)
+        name = 'host-' + hashlib.blake2b(','.join(addresses).encode(),
+                                         digest_size=8).hexdigest()
+        self.host_sets[family][name] = addresses
+        return name
+
+    def prepare_sets(self, family, chain_refs):
+        """
+        Helper function to prepare nft input updating named sets for new
+        rules of given chains.
+
+        :param family: address family (4 or 6)
+        :param chain_refs: dict of chain name -> names of dsthost sets
+        referenced by its new rules
+        :return: tuple of input for nft to load before the rules (creating
+        sets) and after them (removing sets not referenced anymore)
+        :rtype: (str, str)
+        """
+        family_name = self.nft_family[family]
+        table = 'qubes-firewall'
+        nft_sets = []
+
+        dns = self.get_dns_addresses(family)
+        if dns != self.dns_set[family]:
+            nft_sets.append('flush set {} {} dns\n'.format(family_name, table))
+            if dns:
+                nft_sets.append('add element {} {} dns {{ {} }}\n'.format(
+                    family_name, table, ', '.join(dns)))
+
+        loaded = set().union(*self.set_refs[family].values())
+        refs = dict(self.set_refs[family])
+        refs.update(chain_refs)
+        used = set().union(*refs.values())
+        for name in sorted(used - loaded):
+            nft_sets.append(
+                'add set {family} {table} {name} {{ type {addr_type}; }}\n'
+                'add element {family} {table} {name} {{ {elements} }}\n'.format(
+                    family=family_name,
+                    table=table,
+                    name=name,
+                    addr_type=self.addr_type[family],
+                    elements=', '.join(self.host_sets[family][name])))
+        nft_unused = ''.join(
+            'delete set {} {} {}\n'.format(family_name, table, name)
+            for name in sorted(loaded - used))
+        return ''.join(nft_sets), nft_unused
+
+    def sets_applied(self, family, chain_refs):
+        """Record named sets loaded with :py:meth:`prepare_sets` output"""
+        self.dns_set[family] = self.get_dns_addresses(family)
+        self.set_refs[family].update(chain_refs)
+        used = set().union(*self.set_refs[family].values())
+        self.host_sets[family] = {name: addresses
+            for name, addresses in self.host_sets[family].items()
+            if name in used}
 
     def update_connected_ips(self, family):
-        family_name = ('ip6' if family == 6 else 'ip')
+        family_name = self.nft_family[family]
         table = 'qubes-firewall'
 
         nft_input = (
@@ -570,17 +1118,13 @@ class NftablesWorker(FirewallWorker):
         :rtype: str
         """
 
-        assert family in (4, 6)
         nft_rules = []
-        ip_match = 'ip6' if family == 6 else 'ip'
-
-        fullmask = '/128' if family == 6 else '/32'
+        ip_match = self.nft_family[family]
 
-        dns = list(addr + fullmask for addr in self.dns_addresses(family))
+        dns = self.get_dns_addresses(family)
 
-        for rule in rules:
-            unsupported_opts = set(rule.keys()).difference(
-                set(self.supported_rule_opts))
+        for rule in self.merge_rules(rules):
+            unsupported_opts = rule.keys() - self.supported_rule_opts
             if unsupported_opts:
                 raise RuleParseError(
                     'Unsupported rule option(s): {!s}'.format(unsupported_opts))
@@ -589,43 +1133,39 @@ class NftablesWorker(FirewallWorker):
             if 'dst6' in rule and family == 4:
                 raise RuleParseError('dst6 rule found for IPv4 address')
 
-            nft_rule = ""
+            nft_match = []
 
             if rule['action'] == 'accept':
                 action = 'accept'
             elif rule['action'] == 'drop':
-                action = 'reject with icmp{} type admin-prohibited'.format(
-                    'v6' if family == 6 else '')
+                action = self.reject_action[family]
             else:
                 raise RuleParseError(
                     'Invalid rule action {}'.format(rule['action']))
 
             if 'proto' in rule:
-                if family == 4:
-                    nft_rule += ' ip protocol {}'.format(rule['proto'])
-                elif family == 6:
-                    proto = 'icmpv6' if rule['proto'] == 'icmp' \
-                        else rule['proto']
-                    nft_rule += ' ip6 nexthdr {}'.format(proto)
+                nft_match.append(' {} {}'.format(self.proto_match[family],
+                    self.proto_map.get((family, rule['proto']),
+                                       rule['proto'])))
 
             if 'dst4' in rule:
-                nft_rule += ' ip daddr {}'.format(rule['dst4'])
+                nft_match.append(' ip daddr {}'.format(rule['dst4']))
             elif 'dst6' in rule:
-                nft_rule += ' ip6 daddr {}'.format(rule['dst6'])
+                nft_match.append(' ip6 daddr {}'.format(rule['dst6']))
             elif 'dsthost' in rule:
-                try:
-                    addrinfo = socket.getaddrinfo(rule['dsthost'], None,
-                        (socket.AF_INET6 if family == 6 else socket.AF_INET))
-                except socket.gaierror as e:
-                    raise RuleParseError('Failed to resolve {}: {}'.format(
-                        rule['dsthost'], str(e)))
-                nft_rule += ' {} daddr {{ {} }}'.format(ip_match,
-                    ', '.join(set(item[4][0] + fullmask for item in addrinfo)))
+                nft_match.append(' {} daddr @{}'.format(ip_match,
+                    self.host_set(self.resolve(rule['dsthost'], family),
+                                  family)))
 
             if 'dstports' in rule:
-                dstports = rule['dstports']
-                if len(set(dstports.split('-'))) == 1:
-                    dstports = dstports.split('-')[0]
+                port_ranges = [
+                    port_range.split('-')[0]
+                    if len(set(port_range.split('-'))) == 1 else port_range
+                    for port_range in rule['dstports'].split(',')]
+                if len(port_ranges) == 1:
+                    dstports = port_ranges[0]
+                else:
+                    dstports = '{{ {} }}'.format(', '.join(port_ranges))
             else:
                 dstports = None
 
@@ -636,14 +1176,14 @@ class NftablesWorker(FirewallWorker):
                     dstports = '53'
                 if not dns:
                     continue
-                nft_rule += ' {} daddr {{ {} }}'.format(ip_match, ', '.join(
-                    dns))
+                nft_match.append(' {} daddr @dns'.format(ip_match))
 
             if 'icmptype' in rule:
-                if family == 4:
-                    nft_rule += ' icmp type {}'.format(rule['icmptype'])
-                elif family == 6:
-                    nft_rule += ' icmpv6 type {}'.format(rule['icmptype'])
+                nft_match.append(' {} type {}'.format(
+                    self.proto_map.get((family, 'icmp'), 'icmp'),
+                    rule['icmptype']))
+
+            nft_rule = ''.join(nft_match)
 
             # now duplicate rules for tcp/udp if needed
             # it isn't possible to specify "tcp dport xx || udp dport xx" in
@@ -670,7 +1210,7 @@ class NftablesWorker(FirewallWorker):
             '   {rules}\n'
             '  }}\n'
             '}}\n'.format(
-                family=('ip6' if family == 6 else 'ip'),
+                family=self.nft_family[family],
                 table='qubes-firewall',
                 chain=chain,
                 rules='\n   '.join(nft_rules)
@@ -688,10 +1228,23 @@ class NftablesWorker(FirewallWorker):
         """
 
         chain = self.chain_for_addr(source)
-        if chain not in self.chains[family]:
-            self.create_chain(source, chain, family)
-
-        self.run_nft(self.prepare_rules(chain, rules, family))
+        nft_input = self.prepare_rules(chain, rules, family)
+        new_hash = self.script_hash(nft_input)
+        chain_refs = {chain: set(self.host_set_re.findall(nft_input))}
+        nft_sets, nft_unused = self.prepare_sets(family, chain_refs)
+        if chain in self.chains[family]:
+            if not nft_sets and \
+                    self.applied_hash[family].get(chain) == new_hash:
+                # rules not changed, nothing to do
+                return
+        else:
+            # create the chain in the same transaction
+            nft_input = self.prepare_chain(source, chain, family) + nft_input
+        self.applied_hash[family].pop(chain, None)
+        self.run_nft(nft_sets + nft_input + nft_unused)
+        self.chains[family].add(chain)
+        self.applied_hash[family][chain] = new_hash
+        self.sets_applied(family, chain_refs)
 
     def apply_rules(self, source, rules):
         if self.is_ip6(source):
@@ -699,14 +1252,72 @@ class NftablesWorker(FirewallWorker):
         else:
             self.apply_rules_family(source, rules, 4)
 
+    def apply_rules_batch(self, rules_per_source):
+        """
+        Apply rules for multiple source addresses with a single nft call.
+
+        :param rules_per_source: list of (source address, rules list) tuples
+        :return: None
+        """
+
+        nft_input = []
+        new_chains = []
+        new_hash = {}
+        chain_refs = {4: {}, 6: {}}
+        for source, rules in rules_per_source:
+            family = 6 if self.is_ip6(source) else 4
+            chain = self.chain_for_addr(source)
+            if chain not in self.chains[family]:
+                nft_input.append(self.prepare_chain(source, chain, family))
+                new_chains.append((family, chain))
+            chain_input = self.prepare_source_rules(
+                source, chain, rules, family)
+            new_hash[(family, chain)] = self.script_hash(chain_input)
+            chain_refs[family][chain] = \
+                set(self.host_set_re.findall(chain_input))
+            nft_input.append(chain_input)
+
+        if not nft_input:
+            return
+        # sets are shared between chains - create them once, before all the
+        # rules, and remove unused ones only after all chains are updated
+        nft_sets = {}
+        nft_unused = {}
+        for family in (4, 6):
+            if chain_refs[family]:
+                nft_sets[family], nft_unused[family] = \
+                    self.prepare_sets(family, chain_refs[family])
+        for family, chain in new_hash:
+            self.applied_hash[family].pop(chain, None)
+        self.run_nft(''.join(nft_sets.values()) + ''.join(nft_input) +
+                     ''.join(nft_unused.values()))
+        for family, chain in new_chains:
+            self.chains[family].add(chain)
+        for (family, chain), chain_hash in new_hash.items():
+            self.applied_hash[family][chain] = chain_hash
+        for family in nft_sets:
+            self.sets_applied(family, chain_refs[family])
+
     def init(self):
+        for family in (4, 6):
+            self.applied_hash[family].clear()
+            self.host_sets[family].clear()
+            self.set_refs[family].clear()
+            self.dns_set[family] = None
         nft_init = (
             'table {family} qubes-firewall {{\n'
+            '  map addr2chain {{\n'
+            '    type {addr_type} : verdict;\n'
+            '  }}\n'
+            '  set dns {{\n'
+            '    type {addr_type};\n'
+            '  }}\n'
             '  chain forward {{\n'
             '    type filter hook forward priority 0;\n'
             '    policy drop;\n'
             '    ct state established,related accept\n'
             '    meta iifname != "vif*" accept\n'
+            '    {family} saddr vmap @addr2chain\n'
             '  }}\n'
             '  chain prerouting {{\n'
             '    type filter hook prerouting priority -300;\n'
@@ -719,7 +1330,9 @@ class NftablesWorker(FirewallWorker):
             '}}\n'
         )
         nft_init = ''.join(
-            nft_init.format(family=family) for family in ('ip', 'ip6'))
+            nft_init.format(family=self.nft_family[family],
+                            addr_type=self.addr_type[family])
+            for family in (4, 6))
         self.run_nft(nft_init)
 
     def cleanup(self):
@@ -728,6 +1341,11 @@ class NftablesWorker(FirewallWorker):
             'delete table ip6 qubes-firewall\n'
         )
         self.run_nft(nft_cleanup)
+        for family in (4, 6):
+            self.applied_hash[family].clear()
+            self.host_sets[family].clear()
+            self.set_refs[family].clear()
+            self.dns_set[family] = None
 
 
 def main():
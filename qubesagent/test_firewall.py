@@ -1,7 +1,10 @@
 import logging
 import operator
+import socket
+import stat
+import subprocess
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import patch, mock_open, ANY, Mock
 
 import qubesagent.firewall
 
@@ -60,6 +63,12 @@ class FirewallWorker(qubesagent.firewall.FirewallWorker):
         # super(FirewallWorker, self).__init__()
         self.qdb = DummyQubesDB(self)
         self.log = logging.getLogger('qubes.tests')
+        self.dns_cache = {}
+        self.gai_cache = {}
+        self.resolv_conf_mtime = None
+        self.rules_cache = {}
+        self.notify_env = None
+        self.applied_hash = {4: {}, 6: {}}
 
         self.init_called = False
         self.cleanup_called = False
@@ -94,10 +103,20 @@ class IptablesWorker(qubesagent.firewall.IptablesWorker):
         # copied __init__:
         self.qdb = DummyQubesDB(self)
         self.log = logging.getLogger('qubes.tests')
+        self.dns_cache = {}
+        self.gai_cache = {}
+        self.resolv_conf_mtime = None
+        self.rules_cache = {}
+        self.notify_env = None
+        self.applied_hash = {4: {}, 6: {}}
         self.chains = {
             4: set(),
             6: set(),
         }
+        self.applied_rules = {
+            4: {},
+            6: {},
+        }
 
         #: instead of really running `iptables`, log what would be called
         self.called_commands = {
@@ -135,10 +154,19 @@ class NftablesWorker(qubesagent.firewall.NftablesWorker):
         # copied __init__:
         self.qdb = DummyQubesDB(self)
         self.log = logging.getLogger('qubes.tests')
+        self.dns_cache = {}
+        self.gai_cache = {}
+        self.resolv_conf_mtime = None
+        self.rules_cache = {}
+        self.notify_env = None
+        self.applied_hash = {4: {}, 6: {}}
         self.chains = {
             4: set(),
             6: set(),
         }
+        self.host_sets = {4: {}, 6: {}}
+        self.set_refs = {4: {}, 6: {}}
+        self.dns_set = {4: None, 6: None}
 
         #: instead of really running `nft`, log what would be loaded
         #: rules that would be loaded with `nft`
@@ -172,16 +200,20 @@ class TestIptablesWorker(TestCase):
             self.obj.chain_for_addr('fd09:24ef:4179:0000::3'),
             'qbs-09-24ef-4179-0000--3')
 
-    def test_001_create_chain(self):
+    def test_001_prepare_chain(self):
         testdata = [
             (4, '10.137.0.1', 'qbs-10-137-0-1'),
             (6, 'fd09:24ef:4179:0000::3', 'qbs-fd09-24ef-4179-0000--3')
         ]
         for family, addr, chain in testdata:
-            self.obj.create_chain(addr, chain, family)
-            self.assertEqual(self.obj.called_commands[family],
-                [['-N', chain],
-                    ['-I', 'QBS-FORWARD', '-s', addr, '-j', chain]])
+            self.assertEqual(self.obj.prepare_chain(addr, chain, family),
+                '-N {chain}\n'
+                '-I QBS-FORWARD -s {addr} -j {chain}\n'.format(
+                    chain=chain, addr=addr))
+            # existing chain is only flushed
+            self.obj.chains[family].add(chain)
+            self.assertEqual(self.obj.prepare_chain(addr, chain, family),
+                '-F {}\n'.format(chain))
 
     def test_002_prepare_rules4(self):
         rules = [
@@ -257,13 +289,14 @@ class TestIptablesWorker(TestCase):
         rules = [{'action': 'accept'}]
         chain = 'qbs-10-137-0-1'
         self.obj.apply_rules('10.137.0.1', rules)
-        self.assertEqual(self.obj.called_commands[4],
-            [
-                ['-N', chain],
-                ['-I', 'QBS-FORWARD', '-s', '10.137.0.1', '-j', chain],
-                ['-F', chain]])
+        self.assertEqual(self.obj.called_commands[4], [])
         self.assertEqual(self.obj.loaded_iptables[4],
-            self.obj.prepare_rules(chain, rules, 4))
+            "*filter\n"
+            "-N {chain}\n"
+            "-I QBS-FORWARD -s 10.137.0.1 -j {chain}\n"
+            "-A {chain} -j ACCEPT\n"
+            "COMMIT\n".format(chain=chain))
+        self.assertIn(chain, self.obj.chains[4])
         self.assertEqual(self.obj.called_commands[6], [])
         self.assertIsNone(self.obj.loaded_iptables[6])
 
@@ -271,13 +304,14 @@ class TestIptablesWorker(TestCase):
         rules = [{'action': 'accept'}]
         chain = 'qbs-2000--a'
         self.obj.apply_rules('2000::a', rules)
-        self.assertEqual(self.obj.called_commands[6],
-            [
-                ['-N', chain],
-                ['-I', 'QBS-FORWARD', '-s', '2000::a', '-j', chain],
-                ['-F', chain]])
+        self.assertEqual(self.obj.called_commands[6], [])
         self.assertEqual(self.obj.loaded_iptables[6],
-            self.obj.prepare_rules(chain, rules, 6))
+            "*filter\n"
+            "-N {chain}\n"
+            "-I QBS-FORWARD -s 2000::a -j {chain}\n"
+            "-A {chain} -j ACCEPT\n"
+            "COMMIT\n".format(chain=chain))
+        self.assertIn(chain, self.obj.chains[6])
         self.assertEqual(self.obj.called_commands[4], [])
         self.assertIsNone(self.obj.loaded_iptables[4])
 
@@ -300,10 +334,8 @@ class TestIptablesWorker(TestCase):
 
     def test_007_cleanup(self):
         self.obj.init()
-        self.obj.create_chain('1.2.3.4', 'chain-ip4-1', 4)
-        self.obj.create_chain('1.2.3.6', 'chain-ip4-2', 4)
-        self.obj.create_chain('2000::1', 'chain-ip6-1', 6)
-        self.obj.create_chain('2000::2', 'chain-ip6-2', 6)
+        for addr in ('1.2.3.4', '1.2.3.6', '2000::1', '2000::2'):
+            self.obj.apply_rules(addr, [{'action': 'accept'}])
         # forget about commands called earlier
         self.obj.called_commands[4] = []
         self.obj.called_commands[6] = []
@@ -312,22 +344,22 @@ class TestIptablesWorker(TestCase):
                 sorted(self.obj.called_commands[4][1:], key=operator.itemgetter(1)),
             [
                 ['-F', 'QBS-FORWARD'],
-                ['-F', 'chain-ip4-1'],
-                ['-X', 'chain-ip4-1'],
-                ['-F', 'chain-ip4-2'],
-                ['-X', 'chain-ip4-2'],
                 ['-t', 'mangle', '-F', 'QBS-POSTROUTING'],
+                ['-F', 'qbs-1-2-3-4'],
+                ['-X', 'qbs-1-2-3-4'],
+                ['-F', 'qbs-1-2-3-6'],
+                ['-X', 'qbs-1-2-3-6'],
                 ['-t', 'raw', '-F', 'QBS-PREROUTING'],
             ])
         self.assertEqual([self.obj.called_commands[6][0]] +
                 sorted(self.obj.called_commands[6][1:], key=operator.itemgetter(1)),
             [
                 ['-F', 'QBS-FORWARD'],
-                ['-F', 'chain-ip6-1'],
-                ['-X', 'chain-ip6-1'],
-                ['-F', 'chain-ip6-2'],
-                ['-X', 'chain-ip6-2'],
                 ['-t', 'mangle', '-F', 'QBS-POSTROUTING'],
+                ['-F', 'qbs-2000--1'],
+                ['-X', 'qbs-2000--1'],
+                ['-F', 'qbs-2000--2'],
+                ['-X', 'qbs-2000--2'],
                 ['-t', 'raw', '-F', 'QBS-PREROUTING'],
             ])
 
@@ -372,6 +404,130 @@ class TestIptablesWorker(TestCase):
             ['-t', 'mangle', '-F', 'QBS-POSTROUTING'],
         ])
 
+    def test_011_apply_rules_batch(self):
+        rules = [{'action': 'accept'}]
+        self.obj.chains[4].add('qbs-10-137-0-2')
+        self.obj.apply_rules_batch([
+            ('10.137.0.1', rules),
+            ('10.137.0.2', rules),
+            ('2000::a', rules),
+        ])
+        self.assertEqual(self.obj.called_commands[4], [])
+        self.assertEqual(self.obj.called_commands[6], [])
+        self.assertEqual(self.obj.loaded_iptables[4],
+            "*filter\n"
+            "-N qbs-10-137-0-1\n"
+            "-I QBS-FORWARD -s 10.137.0.1 -j qbs-10-137-0-1\n"
+            "-A qbs-10-137-0-1 -j ACCEPT\n"
+            "-F qbs-10-137-0-2\n"
+            "-A qbs-10-137-0-2 -j ACCEPT\n"
+            "COMMIT\n")
+        self.assertEqual(self.obj.loaded_iptables[6],
+            "*filter\n"
+            "-N qbs-2000--a\n"
+            "-I QBS-FORWARD -s 2000::a -j qbs-2000--a\n"
+            "-A qbs-2000--a -j ACCEPT\n"
+            "COMMIT\n")
+        self.assertEqual(self.obj.chains[4],
+            {'qbs-10-137-0-1', 'qbs-10-137-0-2'})
+        self.assertEqual(self.obj.chains[6], {'qbs-2000--a'})
+
+    def test_012_apply_rules_delta(self):
+        rules = [
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '22-22'},
+            {'action': 'accept', 'proto': 'udp', 'dstports': '80-80'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '443-443'},
+            {'action': 'drop'},
+        ]
+        chain = 'qbs-10-137-0-1'
+        self.obj.apply_rules('10.137.0.1', rules)
+
+        rules[1] = {'action': 'accept', 'proto': 'udp', 'dstports': '8080-8080'}
+        self.obj.apply_rules('10.137.0.1', rules)
+        self.assertEqual(self.obj.loaded_iptables[4],
+            "*filter\n"
+            "-D qbs-10-137-0-1 2\n"
+            "-I qbs-10-137-0-1 2 -p udp --dport 8080:8080 -j ACCEPT\n"
+            "COMMIT\n")
+        self.assertEqual(self.obj.applied_rules[4][chain],
+            self.obj.chain_rules(chain,
+                self.obj.prepare_rules(chain, rules, 4)))
+
+        # too many changes - reload the whole chain
+        self.obj.apply_rules('10.137.0.1', [{'action': 'accept'}])
+        self.assertEqual(self.obj.loaded_iptables[4],
+            "*filter\n"
+            "-F qbs-10-137-0-1\n"
+            "-A qbs-10-137-0-1 -j ACCEPT\n"
+            "COMMIT\n")
+        self.assertEqual(self.obj.called_commands[4], [])
+
+    def test_013_prepare_rules_delta(self):
+        old_rules = ['-p tcp -j ACCEPT', '-p udp -j ACCEPT',
+                     '-p icmp -j ACCEPT', '-d 1.2.3.4/32 -j ACCEPT', '-j DROP']
+        new_rules = ['-p udp -j ACCEPT', '-p icmp -j ACCEPT',
+                     '-d 1.2.3.4/32 -j ACCEPT', '-d 1.2.3.5/32 -j ACCEPT',
+                     '-j DROP']
+        self.assertEqual(
+            self.obj.prepare_rules_delta('chain', old_rules, new_rules),
+            "*filter\n"
+            "-I chain 5 -d 1.2.3.5/32 -j ACCEPT\n"
+            "-D chain 1\n"
+            "COMMIT\n")
+        self.assertIsNone(
+            self.obj.prepare_rules_delta('chain', old_rules, ['-j DROP']))
+
+    def test_014_prepare_rules_merged(self):
+        rules = [
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '80-80'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '443-443'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '8000-8999'},
+            {'action': 'accept', 'proto': 'udp', 'dstports': '53-53'},
+            {'action': 'drop'},
+        ]
+        self.assertEqual(self.obj.prepare_rules('chain', rules, 4),
+            "*filter\n"
+            "-A chain -p tcp -m multiport --dports 80,443,8000:8999 "
+            "-j ACCEPT\n"
+            "-A chain -p udp --dport 53:53 -j ACCEPT\n"
+            "-A chain -j REJECT --reject-with icmp-admin-prohibited\n"
+            "COMMIT\n")
+
+    def test_015_apply_rules_unchanged(self):
+        rules = [{'action': 'accept', 'proto': 'tcp', 'dstports': '80-80'}]
+        self.obj.apply_rules('10.137.0.1', rules)
+        self.obj.loaded_iptables[4] = None
+        self.obj.apply_rules('10.137.0.1', rules)
+        self.assertIsNone(self.obj.loaded_iptables[4])
+
+        self.obj.apply_rules_batch([('10.137.0.1', rules)])
+        self.obj.loaded_iptables[4] = None
+        self.obj.apply_rules('10.137.0.1', rules)
+        self.assertIsNone(self.obj.loaded_iptables[4])
+
+        self.obj.cleanup()
+        self.obj.apply_rules('10.137.0.1', rules)
+        self.assertIsNotNone(self.obj.loaded_iptables[4])
+
+    def test_016_apply_rules_batch_invalid(self):
+        self.obj.apply_rules_batch([
+            ('10.137.0.1', [{'action': 'accept'}]),
+            ('10.137.0.2', [{'action': 'accept', 'dst6': 'a::b'}]),
+        ])
+        self.assertEqual(self.obj.loaded_iptables[4],
+            "*filter\n"
+            "-N qbs-10-137-0-1\n"
+            "-I QBS-FORWARD -s 10.137.0.1 -j qbs-10-137-0-1\n"
+            "-A qbs-10-137-0-1 -j ACCEPT\n"
+            "-N qbs-10-137-0-2\n"
+            "-I QBS-FORWARD -s 10.137.0.2 -j qbs-10-137-0-2\n"
+            "-A qbs-10-137-0-2 -j REJECT --reject-with icmp-admin-prohibited\n"
+            "COMMIT\n")
+        self.assertEqual(self.obj.called_commands[4], [])
+        self.subprocess_mock.assert_called_once_with(
+            ['notify-send', '-t', '3000', ANY], env=ANY, stdin=ANY,
+            stdout=ANY, stderr=ANY)
+
 
 class TestNftablesWorker(TestCase):
     def setUp(self):
@@ -395,25 +551,26 @@ class TestNftablesWorker(TestCase):
             'table {family} qubes-firewall {{\n'
             '  chain {chain} {{\n'
             '  }}\n'
-            '  chain forward {{\n'
-            '    {family} saddr {addr} jump {chain}\n'
-            '  }}\n'
-            '}}\n'.format(family=family, addr=addr, chain=chain))
+            '}}\n'
+            'add element {family} qubes-firewall addr2chain '
+            '{{ {addr} : jump {chain} }}\n'.format(
+                family=family, addr=addr, chain=chain))
 
-    def test_001_create_chain(self):
+    def test_001_prepare_chain(self):
         testdata = [
-            (4, '10.137.0.1', 'qbs-10-137-0-1'),
-            (6, 'fd09:24ef:4179:0000::3', 'qbs-fd09-24ef-4179-0000--3')
+            (4, 'ip', '10.137.0.1', 'qbs-10-137-0-1'),
+            (6, 'ip6', 'fd09:24ef:4179:0000::3', 'qbs-fd09-24ef-4179-0000--3')
         ]
-        for family, addr, chain in testdata:
-            self.obj.create_chain(addr, chain, family)
-        self.assertEqual(self.obj.loaded_rules,
-            [self.expected_create_chain('ip', '10.137.0.1', 'qbs-10-137-0-1'),
-             self.expected_create_chain(
-                 'ip6', 'fd09:24ef:4179:0000::3', 'qbs-fd09-24ef-4179-0000--3'),
-             ])
-
-    def test_002_prepare_rules4(self):
+        for family, family_name, addr, chain in testdata:
+            self.assertEqual(self.obj.prepare_chain(addr, chain, family),
+                self.expected_create_chain(family_name, addr, chain))
+
+    @patch('socket.getaddrinfo')
+    def test_002_prepare_rules4(self, mock_getaddrinfo):
+        mock_getaddrinfo.return_value = [
+            (socket.AF_INET, 1, 6, '', ('147.75.32.69', 0)),
+        ]
+        host_set = self.obj.host_set(['147.75.32.69'], 4)
         rules = [
             {'action': 'accept', 'proto': 'tcp',
                 'dstports': '80-80', 'dst4': '1.2.3.0/24'},
@@ -429,11 +586,11 @@ class TestNftablesWorker(TestCase):
             'table ip qubes-firewall {\n'
             '  chain chain {\n'
             '    ip protocol tcp ip daddr 1.2.3.0/24 tcp dport 80 accept\n'
-            '    ip protocol udp ip daddr { 147.75.32.69/32 } '
+            '    ip protocol udp ip daddr @' + host_set + ' '
             'udp dport 443-1024 accept\n'
-            '    ip daddr { 1.1.1.1/32, 2.2.2.2/32 } tcp dport 53 accept\n'
-            '    ip daddr { 1.1.1.1/32, 2.2.2.2/32 } udp dport 53 accept\n'
-            '    ip protocol udp ip daddr { 1.1.1.1/32, 2.2.2.2/32 } udp dport '
+            '    ip daddr @dns tcp dport 53 accept\n'
+            '    ip daddr @dns udp dport 53 accept\n'
+            '    ip protocol udp ip daddr @dns udp dport '
             '53 reject with icmp type admin-prohibited\n'
             '    ip protocol icmp reject with icmp type admin-prohibited\n'
             '    reject with icmp type admin-prohibited\n'
@@ -442,6 +599,8 @@ class TestNftablesWorker(TestCase):
         )
         self.assertEqual(self.obj.prepare_rules('chain', rules, 4),
             expected_nft)
+        self.assertEqual(self.obj.host_sets[4],
+            {host_set: ['147.75.32.69']})
         with self.assertRaises(qubesagent.firewall.RuleParseError):
             self.obj.prepare_rules('chain', [{'unknown': 'xxx'}], 4)
         with self.assertRaises(qubesagent.firewall.RuleParseError):
@@ -449,7 +608,12 @@ class TestNftablesWorker(TestCase):
         with self.assertRaises(qubesagent.firewall.RuleParseError):
             self.obj.prepare_rules('chain', [{'dst4': '3.3.3.3'}], 6)
 
-    def test_003_prepare_rules6(self):
+    @patch('socket.getaddrinfo')
+    def test_003_prepare_rules6(self, mock_getaddrinfo):
+        mock_getaddrinfo.return_value = [
+            (socket.AF_INET6, 1, 6, '', ('2001:67c:2e8:22::c100:68b', 0, 0, 0)),
+        ]
+        host_set = self.obj.host_set(['2001:67c:2e8:22::c100:68b'], 6)
         rules = [
             {'action': 'accept', 'proto': 'tcp',
                 'dstports': '80-80', 'dst6': 'a::b/128'},
@@ -465,11 +629,10 @@ class TestNftablesWorker(TestCase):
             'table ip6 qubes-firewall {\n'
             '  chain chain {\n'
             '    ip6 nexthdr tcp ip6 daddr a::b/128 tcp dport 80 accept\n'
-            '    ip6 nexthdr tcp ip6 daddr { 2001:67c:2e8:22::c100:68b/128 } '
-            'accept\n'
-            '    ip6 daddr { 2001::1/128, 2001::2/128 } tcp dport 53 accept\n'
-            '    ip6 daddr { 2001::1/128, 2001::2/128 } udp dport 53 accept\n'
-            '    ip6 nexthdr udp ip6 daddr { 2001::1/128, 2001::2/128 } '
+            '    ip6 nexthdr tcp ip6 daddr @' + host_set + ' accept\n'
+            '    ip6 daddr @dns tcp dport 53 accept\n'
+            '    ip6 daddr @dns udp dport 53 accept\n'
+            '    ip6 nexthdr udp ip6 daddr @dns '
             'udp dport 53 reject with icmpv6 type admin-prohibited\n'
             '    ip6 nexthdr icmpv6 icmpv6 type 128 reject with icmpv6 type '
             'admin-prohibited\n'
@@ -479,35 +642,50 @@ class TestNftablesWorker(TestCase):
         )
         self.assertEqual(self.obj.prepare_rules('chain', rules, 6),
             expected_nft)
+        self.assertEqual(self.obj.host_sets[6],
+            {host_set: ['2001:67c:2e8:22::c100:68b']})
 
     def test_004_apply_rules4(self):
         rules = [{'action': 'accept'}]
         chain = 'qbs-10-137-0-1'
         self.obj.apply_rules('10.137.0.1', rules)
         self.assertEqual(self.obj.loaded_rules,
-            [self.expected_create_chain('ip', '10.137.0.1', chain),
+            ['flush set ip qubes-firewall dns\n'
+             'add element ip qubes-firewall dns { 1.1.1.1, 2.2.2.2 }\n' +
+             self.expected_create_chain('ip', '10.137.0.1', chain) +
              self.obj.prepare_rules(chain, rules, 4),
              ])
+        self.assertIn(chain, self.obj.chains[4])
 
     def test_005_apply_rules6(self):
         rules = [{'action': 'accept'}]
         chain = 'qbs-2000--a'
         self.obj.apply_rules('2000::a', rules)
         self.assertEqual(self.obj.loaded_rules,
-            [self.expected_create_chain('ip6', '2000::a', chain),
+            ['flush set ip6 qubes-firewall dns\n'
+             'add element ip6 qubes-firewall dns { 2001::1, 2001::2 }\n' +
+             self.expected_create_chain('ip6', '2000::a', chain) +
              self.obj.prepare_rules(chain, rules, 6),
              ])
+        self.assertIn(chain, self.obj.chains[6])
 
     def test_006_init(self):
         self.obj.init()
         self.assertEqual(self.obj.loaded_rules,
         [
             'table ip qubes-firewall {\n'
+            '  map addr2chain {\n'
+            '    type ipv4_addr : verdict;\n'
+            '  }\n'
+            '  set dns {\n'
+            '    type ipv4_addr;\n'
+            '  }\n'
             '  chain forward {\n'
             '    type filter hook forward priority 0;\n'
             '    policy drop;\n'
             '    ct state established,related accept\n'
             '    meta iifname != "vif*" accept\n'
+            '    ip saddr vmap @addr2chain\n'
             '  }\n'
             '  chain prerouting {\n'
             '    type filter hook prerouting priority -300;\n'
@@ -519,11 +697,18 @@ class TestNftablesWorker(TestCase):
             '  }\n'
             '}\n'
             'table ip6 qubes-firewall {\n'
+            '  map addr2chain {\n'
+            '    type ipv6_addr : verdict;\n'
+            '  }\n'
+            '  set dns {\n'
+            '    type ipv6_addr;\n'
+            '  }\n'
             '  chain forward {\n'
             '    type filter hook forward priority 0;\n'
             '    policy drop;\n'
             '    ct state established,related accept\n'
             '    meta iifname != "vif*" accept\n'
+            '    ip6 saddr vmap @addr2chain\n'
             '  }\n'
             '  chain prerouting {\n'
             '    type filter hook prerouting priority -300;\n'
@@ -538,10 +723,8 @@ class TestNftablesWorker(TestCase):
 
     def test_007_cleanup(self):
         self.obj.init()
-        self.obj.create_chain('1.2.3.4', 'chain-ip4-1', 4)
-        self.obj.create_chain('1.2.3.6', 'chain-ip4-2', 4)
-        self.obj.create_chain('2000::1', 'chain-ip6-1', 6)
-        self.obj.create_chain('2000::2', 'chain-ip6-2', 6)
+        for addr in ('1.2.3.4', '1.2.3.6', '2000::1', '2000::2'):
+            self.obj.apply_rules(addr, [{'action': 'accept'}])
         # forget about commands called earlier
         self.obj.loaded_rules = []
         self.obj.cleanup()
@@ -587,6 +770,156 @@ class TestNftablesWorker(TestCase):
             'flush chain ip qubes-firewall postrouting\n'
         ])
 
+    def test_011_apply_rules_batch(self):
+        rules = [{'action': 'accept'}]
+        self.obj.chains[4].add('qbs-10-137-0-2')
+        self.obj.apply_rules_batch([
+            ('10.137.0.1', rules),
+            ('10.137.0.2', rules),
+            ('2000::a', rules),
+        ])
+        self.assertEqual(self.obj.loaded_rules,
+            ['flush set ip qubes-firewall dns\n'
+             'add element ip qubes-firewall dns { 1.1.1.1, 2.2.2.2 }\n'
+             'flush set ip6 qubes-firewall dns\n'
+             'add element ip6 qubes-firewall dns { 2001::1, 2001::2 }\n' +
+             self.expected_create_chain('ip', '10.137.0.1', 'qbs-10-137-0-1') +
+             self.obj.prepare_rules('qbs-10-137-0-1', rules, 4) +
+             self.obj.prepare_rules('qbs-10-137-0-2', rules, 4) +
+             self.expected_create_chain('ip6', '2000::a', 'qbs-2000--a') +
+             self.obj.prepare_rules('qbs-2000--a', rules, 6),
+             ])
+        self.assertEqual(self.obj.chains[4],
+            {'qbs-10-137-0-1', 'qbs-10-137-0-2'})
+        self.assertEqual(self.obj.chains[6], {'qbs-2000--a'})
+
+    def test_012_prepare_rules_merged(self):
+        rules = [
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '80-80'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '443-443'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '8000-8999'},
+            {'action': 'accept', 'proto': 'udp', 'dstports': '53-53'},
+            {'action': 'drop'},
+        ]
+        self.assertEqual(self.obj.prepare_rules('chain', rules, 4),
+            'flush chain ip qubes-firewall chain\n'
+            'table ip qubes-firewall {\n'
+            '  chain chain {\n'
+            '    ip protocol tcp tcp dport { 80, 443, 8000-8999 } accept\n'
+            '    ip protocol udp udp dport 53 accept\n'
+            '    reject with icmp type admin-prohibited\n'
+            '  }\n'
+            '}\n')
+
+    def test_013_run_nft_library(self):
+        self.obj.nft = Mock()
+        self.obj.nft.cmd.return_value = (0, '', '')
+        super(NftablesWorker, self.obj).run_nft('flush ruleset\n')
+        self.obj.nft.cmd.assert_called_once_with('flush ruleset\n')
+
+        self.obj.nft.cmd.return_value = (1, '', 'Error: syntax error')
+        with self.assertRaises(qubesagent.firewall.RuleApplyError):
+            super(NftablesWorker, self.obj).run_nft('invalid\n')
+
+    @patch('qubesagent.firewall.qubesdb')
+    @patch('qubesagent.firewall.nftables')
+    def test_013_run_nft_library_lazy(self, mock_nftables, _mock_qubesdb):
+        mock_nftables.Nftables.return_value.cmd.return_value = (0, '', '')
+        worker = qubesagent.firewall.NftablesWorker()
+        # handle is not created before entering the daemon context
+        mock_nftables.Nftables.assert_not_called()
+        worker.run_nft('flush ruleset\n')
+        worker.run_nft('flush ruleset\n')
+        mock_nftables.Nftables.assert_called_once_with()
+        self.assertEqual(
+            mock_nftables.Nftables.return_value.cmd.call_count, 2)
+
+        # libnftables.so missing
+        mock_nftables.Nftables.side_effect = OSError
+        worker = qubesagent.firewall.NftablesWorker()
+        with patch('subprocess.Popen') as mock_popen:
+            mock_popen.return_value.communicate.return_value = (b'', None)
+            mock_popen.return_value.returncode = 0
+            worker.run_nft('flush ruleset\n')
+        mock_popen.assert_called_once_with(['nft', '-f', '/dev/stdin'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+
+    def test_014_apply_rules_unchanged(self):
+        rules = [{'action': 'accept', 'proto': 'tcp', 'dstports': '80-80'}]
+        self.obj.apply_rules('10.137.0.1', rules)
+        self.obj.apply_rules('10.137.0.1', rules)
+        self.assertEqual(len(self.obj.loaded_rules), 1)
+
+        rules = [{'action': 'drop'}]
+        self.obj.apply_rules('10.137.0.1', rules)
+        self.assertEqual(self.obj.loaded_rules[1:],
+            [self.obj.prepare_rules('qbs-10-137-0-1', rules, 4)])
+
+        # failed update must not be considered applied
+        with patch.object(self.obj, 'run_nft',
+                side_effect=qubesagent.firewall.RuleApplyError):
+            with self.assertRaises(qubesagent.firewall.RuleApplyError):
+                self.obj.apply_rules('10.137.0.1', [{'action': 'accept'}])
+        self.obj.apply_rules('10.137.0.1', rules)
+        self.assertEqual(len(self.obj.loaded_rules), 3)
+
+    @patch('socket.getaddrinfo')
+    def test_015_apply_rules_sets(self, mock_getaddrinfo):
+        mock_getaddrinfo.return_value = [
+            (socket.AF_INET, 1, 6, '', ('192.0.2.1', 0)),
+        ]
+        rules = [{'action': 'accept', 'dsthost': 'example.com'}]
+        host_set = self.obj.host_set(['192.0.2.1'], 4)
+        self.obj.apply_rules('10.137.0.1', rules)
+        self.assertIn(
+            'add set ip qubes-firewall {name} {{ type ipv4_addr; }}\n'
+            'add element ip qubes-firewall {name} {{ 192.0.2.1 }}\n'.format(
+                name=host_set),
+            self.obj.loaded_rules[0])
+
+        # already loaded set is reused, DNS set not reloaded either
+        self.obj.loaded_rules = []
+        self.obj.apply_rules('10.137.0.2', rules)
+        self.assertEqual(self.obj.loaded_rules,
+            [self.expected_create_chain('ip', '10.137.0.2', 'qbs-10-137-0-2') +
+             self.obj.prepare_rules('qbs-10-137-0-2', rules, 4)])
+
+        # set is removed only after the last chain stops using it
+        self.obj.loaded_rules = []
+        self.obj.apply_rules('10.137.0.1', [{'action': 'accept'}])
+        self.assertNotIn('delete set', self.obj.loaded_rules[0])
+        self.obj.apply_rules('10.137.0.2', [{'action': 'accept'}])
+        self.assertTrue(self.obj.loaded_rules[1].endswith(
+            'delete set ip qubes-firewall {}\n'.format(host_set)))
+        self.assertEqual(self.obj.host_sets[4], {})
+
+        # DNS servers changed
+        self.obj.loaded_rules = []
+        self.obj.dns_cache[4] = ['3.3.3.3']
+        self.obj.apply_rules('10.137.0.2', [{'action': 'accept'}])
+        self.assertEqual(self.obj.loaded_rules,
+            ['flush set ip qubes-firewall dns\n'
+             'add element ip qubes-firewall dns { 3.3.3.3 }\n' +
+             self.obj.prepare_rules('qbs-10-137-0-2', [{'action': 'accept'}],
+                                    4)])
+
+    def test_016_apply_rules_batch_invalid(self):
+        self.obj.apply_rules_batch([
+            ('10.137.0.1', [{'action': 'accept'}]),
+            ('10.137.0.2', [{'action': 'accept', 'dst6': 'a::b'}]),
+        ])
+        self.assertEqual(len(self.obj.loaded_rules), 1)
+        self.assertIn(
+            self.obj.prepare_rules('qbs-10-137-0-2', [{'action': 'drop'}], 4),
+            self.obj.loaded_rules[0])
+        self.assertIn(
+            self.obj.prepare_rules('qbs-10-137-0-1', [{'action': 'accept'}], 4),
+            self.obj.loaded_rules[0])
+        self.subprocess_mock.assert_called_once_with(
+            ['notify-send', '-t', '3000', ANY], env=ANY, stdin=ANY,
+            stdout=ANY, stderr=ANY)
+
 class TestFirewallWorker(TestCase):
     def setUp(self):
         self.obj = FirewallWorker()
@@ -598,6 +931,8 @@ class TestFirewallWorker(TestCase):
                 '0002': b'proto=udp action=drop',
             },
             '10.137.0.2': {'policy': b'accept'},
+            # not a rule
+            '10.137.0.5': {'policy': b'accept', '00a1': b'action=accept'},
             # no policy
             '10.137.0.3': {'0000': b'proto=tcp action=accept'},
             # no action
@@ -633,11 +968,108 @@ class TestFirewallWorker(TestCase):
             self.obj.read_rules('10.137.0.3')
         with self.assertRaises(qubesagent.firewall.RuleParseError):
             self.obj.read_rules('10.137.0.4')
+        with self.assertRaises(qubesagent.firewall.RuleParseError):
+            self.obj.read_rules('10.137.0.5')
 
 
+    def test_merge_rules(self):
+        rules = [
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '80-80'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '443-443'},
+            # different action
+            {'action': 'drop', 'proto': 'tcp', 'dstports': '22-22'},
+            # not consecutive
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '8080-8080'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '8443-8443',
+                'dst4': '1.2.3.4'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '9000-9100',
+                'dst4': '1.2.3.4'},
+            # no proto
+            {'action': 'accept', 'dstports': '1000-1000'},
+            {'action': 'accept', 'dstports': '1001-1001'},
+            {'action': 'drop'},
+        ]
+        self.assertEqual(self.obj.merge_rules(rules), [
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '80-80,443-443'},
+            {'action': 'drop', 'proto': 'tcp', 'dstports': '22-22'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '8080-8080'},
+            {'action': 'accept', 'proto': 'tcp',
+                'dstports': '8443-8443,9000-9100', 'dst4': '1.2.3.4'},
+            {'action': 'accept', 'dstports': '1000-1000'},
+            {'action': 'accept', 'dstports': '1001-1001'},
+            {'action': 'drop'},
+        ])
+        # original rules are not modified
+        self.assertEqual(rules[0],
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '80-80'})
+
+    def test_merge_rules_overlap(self):
+        rules = [
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '80-80'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '80-80'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '1000-2000'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '1500-1500'},
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '443-443'},
+        ]
+        self.assertEqual(self.obj.merge_rules(rules), [
+            {'action': 'accept', 'proto': 'tcp', 'dstports': '80-80'},
+            {'action': 'accept', 'proto': 'tcp',
+                'dstports': '80-80,1000-2000'},
+            {'action': 'accept', 'proto': 'tcp',
+                'dstports': '1500-1500,443-443'},
+        ])
+
+    def test_merge_rules_limit(self):
+        rules = [{'action': 'accept', 'proto': 'tcp',
+                  'dstports': '{0}-{0}'.format(port)}
+                 for port in range(1, 21)]
+        merged = self.obj.merge_rules(rules)
+        self.assertEqual([rule['dstports'].count(',') + 1 for rule in merged],
+            [15, 5])
+
+    def test_parse_rule(self):
+        self.assertEqual(
+            self.obj.parse_rule('proto=tcp dstports=80-80 action=drop'),
+            {'proto': 'tcp', 'dstports': '80-80', 'action': 'drop'})
+        with self.assertRaises(qubesagent.firewall.RuleParseError):
+            self.obj.parse_rule('proto=tcp')
+        with self.assertRaises(qubesagent.firewall.RuleParseError):
+            self.obj.parse_rule('proto=tcp dsthost action=accept')
+        with self.assertRaises(qubesagent.firewall.RuleParseError):
+            self.obj.parse_rule('proto=tcp  action=accept')
+
+    def test_read_rules_cache(self):
+        rules1 = self.obj.read_rules('10.137.0.1')
+        self.assertEqual(len(self.obj.rules_cache['10.137.0.1']), 3)
+        # insert a rule at the beginning - other rules get renumbered
+        self.obj.qdb.entries['/qubes-firewall/10.137.0.1/0000'] = \
+            b'proto=icmp action=accept'
+        self.obj.qdb.entries['/qubes-firewall/10.137.0.1/0001'] = \
+            b'proto=tcp dstports=80-80 action=drop'
+        self.obj.qdb.entries['/qubes-firewall/10.137.0.1/0002'] = \
+            b'proto=udp specialtarget=dns action=accept'
+        self.obj.qdb.entries['/qubes-firewall/10.137.0.1/0003'] = \
+            b'proto=udp action=drop'
+        rules2 = self.obj.read_rules('10.137.0.1')
+        self.assertEqual(rules2[0], {'proto': 'icmp', 'action': 'accept'})
+        self.assertIs(rules2[1], rules1[0])
+        self.assertIs(rules2[2], rules1[1])
+        self.assertIs(rules2[3], rules1[2])
+        self.assertEqual(len(self.obj.rules_cache['10.137.0.1']), 4)
+
+        # removed target
+        for key in list(self.obj.qdb.entries):
+            if key.startswith('/qubes-firewall/10.137.0.1/'):
+                del self.obj.qdb.entries[key]
+        with self.assertRaises(qubesagent.firewall.RuleParseError):
+            self.obj.read_rules('10.137.0.1')
+        self.assertNotIn('10.137.0.1', self.obj.rules_cache)
+
     def test_list_targets(self):
+        self.obj.rules_cache['10.137.0.10'] = {}
         self.assertEqual(self.obj.list_targets(), set(['10.137.0.{}'.format(x)
-            for x in range(1, 5)]))
+            for x in range(1, 6)]))
+        self.assertNotIn('10.137.0.10', self.obj.rules_cache)
 
     def test_is_ip6(self):
         self.assertTrue(self.obj.is_ip6('2000::abcd'))
@@ -653,23 +1085,152 @@ class TestFirewallWorker(TestCase):
         self.obj.handle_addr('10.137.0.4')
         self.assertEqual(self.obj.rules['10.137.0.4'], [{'action': 'drop'}])
 
-    @patch('os.path.isfile')
-    @patch('os.access')
+    def test_log_error(self):
+        with patch.dict('os.environ', {'DISPLAY': ':1', 'LANG': 'C'}):
+            self.obj.log_error('test message')
+        self.subprocess_mock.assert_called_once_with(
+            ['notify-send', '-t', '3000', 'test message'],
+            env=ANY,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        env = self.subprocess_mock.call_args[1]['env']
+        self.assertEqual(env['DISPLAY'], ':0')
+        self.assertEqual(env['LANG'], 'C')
+
+    def test_handle_addrs(self):
+        self.obj.handle_addrs(['10.137.0.1', '10.137.0.2', '10.137.0.3'])
+        self.assertEqual(self.obj.rules['10.137.0.2'], [{'action': 'accept'}])
+        self.assertEqual(len(self.obj.rules['10.137.0.1']), 4)
+        # fallback to block all
+        self.assertEqual(self.obj.rules['10.137.0.3'], [{'action': 'drop'}])
+
+    def test_handle_addrs_fallback(self):
+        with patch.object(self.obj, 'apply_rules_batch',
+                side_effect=qubesagent.firewall.RuleApplyError('test')):
+            self.obj.handle_addrs(['10.137.0.2', '10.137.0.4'])
+        self.assertEqual(self.obj.rules['10.137.0.2'], [{'action': 'accept'}])
+        self.assertEqual(self.obj.rules['10.137.0.4'], [{'action': 'drop'}])
+
+    @patch('socket.getaddrinfo')
+    def test_resolve(self, mock_getaddrinfo):
+        mock_getaddrinfo.return_value = [
+            (socket.AF_INET, 1, 6, '', ('1.2.3.4', 0)),
+            (socket.AF_INET, 2, 17, '', ('1.2.3.4', 0)),
+            (socket.AF_INET, 1, 6, '', ('1.2.3.5', 0)),
+        ]
+        self.assertEqual(self.obj.resolve('example.com', 4),
+            {'1.2.3.4', '1.2.3.5'})
+        self.assertEqual(self.obj.resolve('example.com', 4),
+            {'1.2.3.4', '1.2.3.5'})
+        # only the family actually needed is queried
+        mock_getaddrinfo.assert_called_once_with(
+            'example.com', None, socket.AF_INET)
+        mock_getaddrinfo.return_value = [
+            (socket.AF_INET6, 1, 6, '', ('2000::1', 0, 0, 0)),
+        ]
+        self.assertEqual(self.obj.resolve('example.com', 6), {'2000::1'})
+        mock_getaddrinfo.assert_called_with(
+            'example.com', None, socket.AF_INET6)
+        self.assertEqual(mock_getaddrinfo.call_count, 2)
+        self.obj.clear_caches()
+        self.obj.resolve('example.com', 6)
+        self.assertEqual(mock_getaddrinfo.call_count, 3)
+
+        mock_getaddrinfo.side_effect = socket.gaierror(-2, 'Name unknown')
+        with self.assertRaises(qubesagent.firewall.RuleParseError):
+            self.obj.resolve('nonexistent.example.com', 4)
+        with self.assertRaises(qubesagent.firewall.RuleParseError):
+            self.obj.resolve('nonexistent.example.com', 4)
+        self.assertEqual(mock_getaddrinfo.call_count, 4)
+
+    @patch('socket.getaddrinfo')
+    def test_resolve_batch(self, mock_getaddrinfo):
+        def getaddrinfo(host, port):
+            if host == 'nonexistent.example.com':
+                raise socket.gaierror(-2, 'Name unknown')
+            return [(socket.AF_INET6, 1, 6, '', ('2000::1', 0, 0, 0)),
+                    (socket.AF_INET, 1, 6, '', ('1.2.3.4', 0))]
+        mock_getaddrinfo.side_effect = getaddrinfo
+        rules = [
+            {'action': 'accept', 'dsthost': 'example.com'},
+            {'action': 'accept', 'dsthost': 'nonexistent.example.com'},
+            {'action': 'accept', 'dst4': '1.2.3.0/24'},
+            {'action': 'drop'},
+        ]
+        self.obj.resolve_batch([
+            ('10.137.0.1', rules),
+            ('10.137.0.2', rules),
+            ('2000::a', rules[:1]),
+        ])
+        self.assertEqual(mock_getaddrinfo.call_count, 2)
+        self.assertEqual(self.obj.resolve('example.com', 4), {'1.2.3.4'})
+        self.assertEqual(self.obj.resolve('example.com', 6), {'2000::1'})
+        with self.assertRaises(qubesagent.firewall.RuleParseError):
+            self.obj.resolve('nonexistent.example.com', 4)
+        self.assertEqual(mock_getaddrinfo.call_count, 2)
+
+        mock_getaddrinfo.side_effect = None
+        mock_getaddrinfo.return_value = [
+            (socket.AF_INET, 1, 6, '', ('1.2.3.4', 0)),
+        ]
+        self.obj.resolve_batch([('10.137.0.1', [
+            {'action': 'accept', 'dsthost': 'ipv4only.example.com'}])])
+        with self.assertRaises(qubesagent.firewall.RuleParseError):
+            self.obj.resolve('ipv4only.example.com', 6)
+        self.assertEqual(mock_getaddrinfo.call_count, 3)
+
+    def test_dns_addresses(self):
+        resolv_conf = (
+            '# Generated by NetworkManager\n'
+            'search example.com\n'
+            'nameserver 10.139.1.1\n'
+            'nameserver\t10.139.1.2\n'
+            'nameserver fd09:24ef:4179::a8b:1\n'
+            'nameserver\n'
+            'options rotate\n'
+        )
+        with patch('builtins.open', mock_open(read_data=resolv_conf)):
+            self.assertEqual(list(self.obj.dns_addresses(4)),
+                ['10.139.1.1', '10.139.1.2'])
+            self.assertEqual(list(self.obj.dns_addresses(6)),
+                ['fd09:24ef:4179::a8b:1'])
+            self.assertEqual(list(self.obj.dns_addresses()),
+                ['10.139.1.1', '10.139.1.2', 'fd09:24ef:4179::a8b:1'])
+
+    @patch('os.stat')
+    def test_check_resolv_conf(self, mock_stat):
+        mock_stat.return_value.st_mtime = 1
+        self.obj.check_resolv_conf()
+        with patch.object(self.obj, 'dns_addresses',
+                return_value=['1.1.1.1']) as mock_dns:
+            self.assertEqual(self.obj.get_dns_addresses(4), ['1.1.1.1'])
+            self.assertEqual(self.obj.get_dns_addresses(4), ['1.1.1.1'])
+            self.obj.check_resolv_conf()
+            self.obj.get_dns_addresses(4)
+            self.assertEqual(mock_dns.call_count, 1)
+            mock_stat.return_value.st_mtime = 2
+            self.obj.check_resolv_conf()
+            self.obj.get_dns_addresses(4)
+            self.assertEqual(mock_dns.call_count, 2)
+
+    @patch('os.stat')
     @patch('subprocess.call')
-    def test_run_user_script(self, mock_subprocess, mock_os_access,
-            mock_os_path_isfile):
-        mock_os_path_isfile.return_value = False
-        mock_os_access.return_value = False
+    def test_run_user_script(self, mock_subprocess, mock_os_stat):
+        mock_os_stat.side_effect = FileNotFoundError
+        super(FirewallWorker, self.obj).run_user_script()
+        self.assertFalse(mock_subprocess.called)
+
+        mock_os_stat.side_effect = None
+        mock_os_stat.return_value.st_mode = stat.S_IFREG | 0o644
         super(FirewallWorker, self.obj).run_user_script()
         self.assertFalse(mock_subprocess.called)
 
-        mock_os_path_isfile.return_value = True
-        mock_os_access.return_value = False
+        mock_os_stat.return_value.st_mode = stat.S_IFDIR | 0o755
         super(FirewallWorker, self.obj).run_user_script()
         self.assertFalse(mock_subprocess.called)
 
-        mock_os_path_isfile.return_value = True
-        mock_os_access.return_value = True
+        mock_os_stat.return_value.st_mode = stat.S_IFREG | 0o755
         super(FirewallWorker, self.obj).run_user_script()
         mock_subprocess.assert_called_once_with(
             ['/rw/config/qubes-firewall-user-script'])